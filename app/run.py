@@ -5,147 +5,291 @@ This script also allows the user to create new tables and select data from datab
 
 This tool accepts .json files with array structure.
 
-This class requires that 'ijson' be installed.
+This script requires that 'ijson', 'msgspec', 'bitarray' and 'pgcopy' be installed.
+Files up to json_size_limit are decoded at once by 'msgspec' (memory-mapped)
+directly into CityRecord structs, bigger files are streamed by the fastest 
+available ijson backend (C extension 'yajl2_c' first).
 
 Variables
 ---------
-buff_size: int
-    Buffer size (number of records) collecting data from importing file before import to database
+pool_size: int
+    Pool size (number of rows of all tables) collecting data from importing file before import to database
 data_path: str
     Import file path
+json_size_limit: int
+    Max file size (bytes) parsed at once in memory, bigger files are streamed
+city_ids_size: int
+    Initial size (number of ids) of bitset of already imported cities ids
 """
 
-import ijson
+try:
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    try:
+        import ijson.backends.yajl2_cffi as ijson
+    except ImportError:
+        try:
+            import ijson.backends.yajl2 as ijson
+        except ImportError:
+            import ijson.backends.python as ijson
+import msgspec
+from bitarray import bitarray
+from bitarray.util import zeros
 import typing
 import os
-from typing import Union
+import mmap
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import chain, islice
+from operator import attrgetter
 from src.database import Database, db_config
-from src.logging_tools import func_status
+from src.logging_tools import configure_logging, func_status
 
-buff_size:int = 10000
+pool_size:int = 40000
 data_path:str = os.path.join('data', 'cities.json')
+json_size_limit:int = 100 * 1024 * 1024
+city_ids_size:int = 4 * 1024 * 1024
+
+class CityRecord(msgspec.Struct, gc=False):
+    """Record of imported json file (schema used for decoding)
+
+    Records hold only scalar values (no reference cycles possible), 
+    so they are not tracked by garbage collector - whole decoded file 
+    is not scanned by every collection triggered while importing
+    """
+    id:int
+    name:str
+    state_id:int
+    state_code:str
+    state_name:str
+    country_id:int
+    country_code:str
+    country_name:str
+    # Coordinates are numeric strings in json file, 
+    # they are converted to float by non-strict decoding
+    latitude:float
+    longitude:float
+    wikiDataId:typing.Optional[str] = None
+
+records_decoder = msgspec.json.Decoder(list[CityRecord], strict=False)
+
+# Duplicates between buffers are removed by 'ON CONFLICT'
+INSERT_STATES_SQL:str = ("INSERT INTO states (id, code, name) "
+    "SELECT * FROM UNNEST(%s::int[], %s::text[], %s::text[]) "
+    "ON CONFLICT (id) DO NOTHING")
+INSERT_COUNTRIES_SQL:str = ("INSERT INTO countries (id, code, name) "
+    "SELECT * FROM UNNEST(%s::int[], %s::text[], %s::text[]) "
+    "ON CONFLICT (id) DO NOTHING")
+INSERT_STATEMENTS:typing.Dict[str, str] = {
+    'states': INSERT_STATES_SQL,
+    'countries': INSERT_COUNTRIES_SQL}
 
 @func_status
 def create_db_structures(db:Database) -> None:
     create_statements: list[str] = [
-        """CREATE TABLE states (
+        """CREATE TABLE IF NOT EXISTS states (
         id INTEGER NOT NULL,
         code VARCHAR(255),
         name VARCHAR(255),
         PRIMARY KEY (id)
         )""",
-        """CREATE TABLE countries (
+        """CREATE TABLE IF NOT EXISTS countries (
         id INTEGER NOT NULL,
         code VARCHAR(255),
         name VARCHAR(255),
         PRIMARY KEY (id)
         )""",
-        """CREATE TABLE cities (
+        """CREATE TABLE IF NOT EXISTS cities (
         id INTEGER NOT NULL,
         name VARCHAR(255),
         state_id INTEGER,
         country_id INTEGER,
-        latitude VARCHAR(255),
-        longitude VARCHAR(255),
+        latitude DOUBLE PRECISION,
+        longitude DOUBLE PRECISION,
         wikiDataId VARCHAR(255),
         PRIMARY KEY (id),
-        FOREIGN KEY (state_id) REFERENCES states (id),
-        FOREIGN KEY (country_id) REFERENCES countries (id)
+        FOREIGN KEY (state_id) REFERENCES states (id) 
+            DEFERRABLE INITIALLY DEFERRED,
+        FOREIGN KEY (country_id) REFERENCES countries (id) 
+            DEFERRABLE INITIALLY DEFERRED
         )""",
-        """DROP TABLE IF EXISTS cities_tmp;
-        """,
-        """CREATE TABLE cities_tmp (
-        id INTEGER NOT NULL,
-        name VARCHAR(255),
-        state_id INTEGER,
-        country_id INTEGER,
-        latitude VARCHAR(255),
-        longitude VARCHAR(255),
-        wikiDataId VARCHAR(255),
-        PRIMARY KEY (id)
-        )"""]
-    for create_statement in create_statements:
-        db.create_table(create_statement) 
+        # Migration of "cities" created by previous versions of the script
+        # (foreign keys were not deferrable, coordinates were VARCHAR, 
+        # data was loaded through "cities_tmp" table)
+        # Only not deferrable foreign keys are altered (found by catalog, 
+        # so FK triggers are not rewritten every run)
+        """DO $$
+        DECLARE
+            fk_name name;
+        BEGIN
+            FOR fk_name IN
+                SELECT conname FROM pg_constraint
+                WHERE conrelid = 'cities'::regclass 
+                AND contype = 'f' AND NOT condeferrable
+            LOOP
+                EXECUTE format('ALTER TABLE cities ALTER CONSTRAINT %I '
+                            'DEFERRABLE INITIALLY DEFERRED', fk_name);
+            END LOOP;
+        END $$""",
+        # Column types are checked first, so table is not rewritten every run
+        """DO $$
+        BEGIN
+            IF (SELECT data_type FROM information_schema.columns
+                WHERE table_schema = current_schema() 
+                AND table_name = 'cities' AND column_name = 'latitude'
+                ) <> 'double precision' THEN
+                ALTER TABLE cities 
+                ALTER COLUMN latitude TYPE double precision 
+                    USING latitude::double precision,
+                ALTER COLUMN longitude TYPE double precision 
+                    USING longitude::double precision;
+            END IF;
+        END $$""",
+        """DROP TABLE IF EXISTS cities_tmp"""]
+    # Statements are sent together (one round trip), so each of them 
+    # is idempotent - any error aborts the import
+    db.create_table(';\n'.join(create_statements))
+
+@func_status
+def read_json_records(f:typing.BinaryIO) -> typing.Iterable[CityRecord]:
+    """Decodes whole file with msgspec if it is not bigger than json_size_limit,
+    otherwise returns ijson stream of records (converted to CityRecord)"""
+    file_size:int = os.fstat(f.fileno()).st_size
+    if not 0 < file_size <= json_size_limit:
+        return (msgspec.convert(record, CityRecord, strict=False) 
+                for record in ijson.items(f, 'item', use_float=True))
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+        with memoryview(mapped_file) as view:
+            return records_decoder.decode(view)
+
+@func_status
+def select_city_ids(db:Database) -> tuple[bitarray, set[int]]:
+    """Returns bitset of (non-negative) cities ids and set of negative 
+    cities ids already imported to database"""
+    seen_city_ids:bitarray = zeros(city_ids_size)
+    negative_city_ids:set[int] = set()
+    # Ids are streamed, so they are not all fetched into memory at once
+    for (city_id,) in db.select_stream('SELECT id FROM cities;')[1]:
+        if city_id < 0:
+            negative_city_ids.add(city_id)
+            continue
+        if city_id >= len(seen_city_ids):
+            seen_city_ids.extend(zeros(city_id + 1))
+        seen_city_ids[city_id] = 1
+    return seen_city_ids, negative_city_ids
+
+def split_records(records:typing.Iterable[CityRecord], 
+                import_data:typing.Dict[str, typing.Dict[int, tuple]],
+                seen_city_ids:bitarray, 
+                negative_city_ids:set[int]
+                ) -> typing.Iterator[tuple]:
+    """Yields "cities" rows (skipping ids set in seen_city_ids or 
+    negative_city_ids and marking yielded ones) and collects "states" 
+    and "countries" rows into import_data dictionaries keyed by id 
+    (which delete duplicates)"""
+    states:typing.Dict[int, tuple] = import_data['states']
+    countries:typing.Dict[int, tuple] = import_data['countries']
+    # Rows are built from records by C-implemented getters 
+    # (one call instead of lookup per field)
+    get_city = attrgetter('id', 'name', 'state_id', 'country_id', 
+                        'latitude', 'longitude', 'wikiDataId')
+    get_state = attrgetter('state_id', 'state_code', 'state_name')
+    get_country = attrgetter('country_id', 'country_code', 'country_name')
+    # Cities ids are dense integers, so duplicates are detected by bitset
+    # (1 bit per id, grown when bigger id occurs). Negative ids would be 
+    # indexed from the end of bitset, so they are kept in set
+    for record in records:
+        city_id:int = record.id
+        if city_id < 0:
+            if city_id in negative_city_ids:
+                continue
+            negative_city_ids.add(city_id)
+        else:
+            if city_id >= len(seen_city_ids):
+                seen_city_ids.extend(zeros(city_id + 1))
+            if seen_city_ids[city_id]:
+                continue
+            seen_city_ids[city_id] = 1
+        # Row tuple is built only for the first occurrence of id
+        if record.state_id not in states:
+            state:tuple = get_state(record)
+            states[state[0]] = state
+        if record.country_id not in countries:
+            country:tuple = get_country(record)
+            countries[country[0]] = country
+        yield get_city(record)
 
 @func_status
 def insert_json_to_db(db:Database, json_path:str) -> None:
-    insert_statements:typing.Dict[str, str] = {
-        'cities': """INSERT INTO cities_tmp (id, name, state_id, country_id,
-                                             latitude, longitude, wikiDataId) 
-                    VALUES %s 
-                    ON CONFLICT (id) DO NOTHING;
-                    """,
-        'states': """INSERT INTO states (id, code, name) 
-                    VALUES %s 
-                    ON CONFLICT (id) DO NOTHING;
-                    """,
-        'countries': """INSERT INTO countries (id, code, name) 
-                    VALUES %s 
-                    ON CONFLICT (id) DO NOTHING;
-                    """}
+    # Binary COPY quotes column names, so they must match 
+    # the lower case names created by Postgres
+    cities_columns:list[str] = ['id', 'name', 'state_id', 'country_id', 
+                                'latitude', 'longitude', 'wikidataid']
+    cities_copy_manager = db.copy_manager('cities', cities_columns)
+    # "cities" rows are copied without 'ON CONFLICT', so rows already 
+    # imported (and duplicates in file) are skipped before copy
+    seen_city_ids, negative_city_ids = select_city_ids(db)
     with open(json_path, 'rb') as f:
-        import_data:typing.Dict[str, Union[set[tuple], list[tuple]]] = {
-                        'states':set(), 'countries':set(), 'cities':list()
+        import_data:typing.Dict[str, typing.Dict[int, tuple]] = {
+                        'states':dict(), 'countries':dict()
                         }
-        # Reads json file item by item and splits data to buffers
-        for record in ijson.items(f, 'item'):
-            import_data['states'].add((record['state_id'], 
-                                    record['state_code'], 
-                                    record['state_name']))
-            import_data['countries'].add((record['country_id'], 
-                                        record['country_code'], 
-                                        record['country_name']))
-            import_data['cities'].append((record['id'], 
-                                        record['name'], 
-                                        record['state_id'], 
-                                        record['country_id'], 
-                                        record['latitude'], 
-                                        record['longitude'], 
-                                        record['wikiDataId']))
-            # Imports and cleans buffers when equal to buff_size
-            # Counting each buffer size separately because 'states' 
-            # and 'countries' data have a lot of duplicates 
-            # (which are deleted by usage SET collection)                        
-            if len(import_data['cities'])==buff_size:
-                db.insert_values(insert_statements['cities'], 
-                                import_data['cities'])
-                import_data['cities'] = list()
-            if len(import_data['states'])==buff_size:
-                db.insert_values(insert_statements['states'], 
-                                import_data['states'])
-                import_data['states'] = set()
-            if len(import_data['countries'])==buff_size:
-                db.insert_values(insert_statements['countries'], 
-                                import_data['countries'])
-                import_data['countries'] = set()
+        # Reads json file record by record and splits data to tables
+        cities:typing.Iterator[tuple] = split_records(read_json_records(f), 
+                                                    import_data, 
+                                                    seen_city_ids, 
+                                                    negative_city_ids)
+        # Number of "countries" and "states" rows waiting in the pool
+        def pending_rows() -> int:
+            return len(import_data['countries']) + len(import_data['states'])
+        # Imports "countries" and "states" rows in dependency order 
+        # and cleans their buffers
+        def flush_dependencies() -> None:
+            for table in ('countries', 'states'):
+                if len(import_data[table]):
+                    db.insert_values(INSERT_STATEMENTS[table], 
+                                    import_data[table].values())
+                    import_data[table].clear()
+        # One pool of pool_size rows is collected for all tables.
+        # 'states' and 'countries' data have a lot of duplicates 
+        # (which are deleted by usage dictionaries keyed by id), 
+        # so they rarely fill the pool and are mostly imported once on exit.
+        # Each loop serializes "cities" rows filling the rest of the pool, 
+        # which are streamed from the generator (no intermediate list).
+        # Serialized rows are copied in background thread, so JSON parsing 
+        # of the next rows overlaps with the database import. Only one copy 
+        # is in progress, previous one is awaited before using connection
+        pending_copy:typing.Optional[Future] = None
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for city in cities:
+                cities_rows:int = max(pool_size - pending_rows(), 1)
+                cities_stream:typing.BinaryIO = db.write_binary(
+                            cities_copy_manager, 
+                            chain((city,), islice(cities, cities_rows - 1)))
+                if pending_copy is not None:
+                    pending_copy.result()
+                if pending_rows()>=pool_size:
+                    flush_dependencies()
+                pending_copy = executor.submit(db.copy_binary_stream, 
+                                            cities_copy_manager, cities_stream)
+            if pending_copy is not None:
+                pending_copy.result()
         # Imports buffers on exit - they can have not imported data
-        if len(import_data['cities']):
-            db.insert_values(insert_statements['cities'], 
-                            import_data['cities'])
-        if len(import_data['states']):
-            db.insert_values(insert_statements['states'], 
-                            import_data['states'])
-        if len(import_data['countries']):
-            db.insert_values(insert_statements['countries'], 
-                            import_data['countries'])
-
-@func_status
-def move_data_from_tmp_table(db:Database) -> None:
-    db.insert_by_select_from("""INSERT INTO cities 
-                                    SELECT * FROM cities_tmp 
-                                    ON CONFLICT (id) DO NOTHING;""")
+        flush_dependencies()
 
 @func_status
 def import_data_to_db(db:Database, data_path:str) -> None:
+    # Whole import is a single transaction (one commit instead of 
+    # commit per batch), WAL flush is not awaited on its commit 
+    # (set locally - pooled connection is reused by other transactions)
+    db.begin()
+    db.set_config('synchronous_commit', 'off', local=True)
     # Prepare db structures if not exists
     create_db_structures(db)
     # Splits json data to tables (normalization)
-    # Because of usage foreign keys, table "cities" can't be load in 1 step
-    # Reading JSON is slow, so "cities" data is inserted into temp table
+    # Foreign keys of "cities" are checked on commit, so "cities" data 
+    # can be copied before "states" and "countries" data is loaded
+    db.defer_constraints()
     insert_json_to_db(db, data_path)
-    # Foreign keys tables are loaded
-    # Move data from tmp table to target table ("cities")
-    move_data_from_tmp_table(db)
+    db.commit()
 
 @func_status
 def select_number_of_cities(db:Database, country_name:str, 
@@ -184,12 +328,13 @@ def number_of_cities(db:Database, *, country_name:str,
 def main() -> None:
     db_params:typing.Dict[str,str] = db_config(filename='database.ini', 
                                             section='postgresql')                                          
-    db = Database(**db_params)
-    # 'import_data_to_db' can be commented if only select is needed
-    import_data_to_db(db, data_path)
-    number_of_cities(db, country_name='Poland', 
-                state_name='Masovian Voivodeship')
+    with Database(**db_params) as db:
+        # 'import_data_to_db' can be commented if only select is needed
+        import_data_to_db(db, data_path)
+        number_of_cities(db, country_name='Poland', 
+                    state_name='Masovian Voivodeship')
         
 
 if __name__ == '__main__':
+    configure_logging()
     main()
@@ -7,5 +7,6 @@ setup(
     license = 'MIT',
     package_dir = {'': 'src'},
     py_modules = ['database', 'logging_tools'],
-    install_requires=['ijson==3.1.4', 'psycopg2==2.9.3']
+    install_requires=['ijson>=3.2', 'psycopg2==2.9.3', 'pgcopy==1.5.0',
+                      'msgspec==0.18.6', 'bitarray==2.5.1']
 )
\ No newline at end of file
@@ -1,15 +1,44 @@
-import psycopg2
-from psycopg2.errors import DuplicateTable
-from psycopg2.extras import execute_values
+import io
+import re
+import uuid
+from itertools import chain, count, islice
+from psycopg2.pool import ThreadedConnectionPool
+from pgcopy import CopyManager
 from configparser import ConfigParser
 import typing
 
 
+# Connection pools shared by Database objects (one per database parameters)
+connection_pools:typing.Dict[tuple, ThreadedConnectionPool] = {}
+
+
+def get_connection_pool(**db_params:str) -> ThreadedConnectionPool:
+    """Returns connection pool for database parameters (creates it on first use)
+
+    Parameters
+    ----------
+    db_params : str
+        database parameters to establish a connection
+
+    Returns
+    -------
+    ThreadedConnectionPool
+        Pool of (1 to 4) database connections
+    """
+
+    key:tuple = tuple(sorted(db_params.items()))
+    if key not in connection_pools:
+        connection_pools[key] = ThreadedConnectionPool(1, 4, **db_params)
+    return connection_pools[key]
+
+
 class Database:
     """
     A class used to connect to Postgres database
 
-    This class requires that 'psycopg2' be installed.
+    This class requires that 'psycopg2' and 'pgcopy' be installed.
+    It should be used as context manager ('with Database(...) as db:'), 
+    which commits on exit and returns connection to the pool.
 
     ...
 
@@ -17,21 +46,47 @@ class Database:
     ----------
     db_params : str
         database parameters to establish a connection
+    pool : ThreadedConnectionPool
+        pool the database connection is taken from
     conn : connection
         database connection
     cur : cursor
         database cursor
+    prepared_statements : Dict[str, str]
+        names of statements prepared on the connection (by SQL)
 
     Methods
     -------
+    close()
+        Rollbacks uncommitted changes and returns connection to the pool
+    begin()
+        Starts new transaction
+    commit()
+        Commits current transaction
+    set_config(name, value, local=False)
+        Sets run-time configuration parameter
+    defer_constraints()
+        Defers checking of deferrable constraints to commit
     create_table(sql)
         Creates database table
     insert_values(sql, data)
         Inserts data from python script to database table
+    copy_manager(table, columns)
+        Creates manager for binary copy to database table
+    write_binary(manager, rows)
+        Serializes data to binary COPY format
+    copy_binary_stream(manager, stream)
+        Copies serialized data to database table (binary COPY)
     insert_by_select_from(sql)
         Inserts data from database table to database table
+    execute_prepared(sql, values=None)
+        Executes SQL statement as prepared statement
     select_all(sql, values=None)
         Selects data from database
+    select_stream(sql, values=None)
+        Selects data from database by server-side cursor (generator of records)
+    stream_records(cur, records)
+        Yields records and closes server-side cursor when they are consumed
     """
 
     def __init__(self, **db_params:str) -> None:
@@ -40,21 +95,89 @@ class Database:
         ----------
         db_params : str
             database parameters to establish a connection
+        pool : ThreadedConnectionPool
+            pool the database connection is taken from
         conn : connection
             database connection
         cur : cursor
             database cursor
+        prepared_statements : Dict[str, str]
+            names of statements prepared on the connection (by SQL)
         """
 
-        self.conn = psycopg2.connect(**db_params)
+        self.pool = get_connection_pool(**db_params)
+        self.conn = self.pool.getconn()
         self.cur = self.conn.cursor()
+        self.prepared_statements:typing.Dict[str, str] = {}
+
+    def __enter__(self) -> 'Database':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        """Commits transaction (or rollbacks it if exception was raised) 
+        and returns connection to the pool when leaving 'with' block"""
+
+        # Deferred constraints are checked on commit, so it can fail too
+        try:
+            if exc_type is None:
+                self.commit()
+        finally:
+            self.close()
 
-    def __del__(self) -> None:
-        """Rollbacks and cleans connection when references to the object have been deleted"""
+    def close(self) -> None:
+        """Rollbacks uncommitted changes and returns connection to the pool"""
+
+        # Connection is returned even if it is broken (then it is closed 
+        # by the pool instead of being reused)
+        is_clean:bool = False
+        try:
+            self.conn.rollback()
+            # Prepared statements live as long as connection, which is reused
+            if self.prepared_statements:
+                self.cur.execute('DEALLOCATE ALL')
+                self.conn.commit()
+            is_clean = True
+        finally:
+            self.prepared_statements.clear()
+            self.cur.close()
+            self.pool.putconn(self.conn, close=not is_clean)
+
+    def begin(self) -> None:
+        """Starts new transaction (uncommitted changes are rolled back)
+
+        psycopg2 opens transaction implicitly with the first statement, 
+        so methods below do not commit - call commit method when all 
+        statements of the transaction are executed.
+        """
 
         self.conn.rollback()
-        self.cur.close()
-        self.conn.close()
+
+    def commit(self) -> None:
+        """Commits current transaction"""
+
+        self.conn.commit()
+
+    def set_config(self, name:str, value:str, local:bool=False) -> None:
+        """Sets run-time configuration parameter
+
+        Parameters
+        ----------
+        name: str
+            Configuration parameter name (e.g. 'synchronous_commit')
+        value: str
+            New value of configuration parameter
+        local: bool, optional
+            If True, value is set only for current transaction, 
+            otherwise for the session
+        """
+
+        self.cur.execute('SELECT set_config(%s, %s, %s)', (name, value, local))
+
+    def defer_constraints(self) -> None:
+        """Defers checking of deferrable constraints (e.g. foreign keys) 
+        to the end of current transaction"""
+
+        self.cur.execute('SET CONSTRAINTS ALL DEFERRED')
 
     def create_table(self, sql:str) -> None:
         """Executes SQL statement for creating or dropping table
@@ -67,29 +190,99 @@ class Database:
 
         try:
             self.cur.execute(sql)
-            self.conn.commit()
-        except DuplicateTable:
-            self.conn.rollback()
         except Exception:
             self.conn.rollback()
+            raise
 
-    def insert_values(self, sql:str, data:list[tuple]) -> None:
+    def insert_values(self, sql:str, data:typing.Iterable[tuple]) -> None:
         """Inserts data from python script to database table
 
+        Rows are transposed into column arrays, so statement is sent 
+        with one parameter per column (number of rows does not change 
+        statement and is not limited by number of bindable parameters).
+        Statement is prepared once and only executed for next data.
+
         Parameters
         ----------
         sql: str
-            SQL 'INSERT INTO ... VALUES ...' statement
-        data: list[tuple]
-            List of tuples of values to insert into table 
+            SQL 'INSERT INTO ... SELECT * FROM UNNEST(%s::type[], ...)' statement 
+            with one placeholder per column
+        data: Iterable[tuple]
+            Tuples of values to insert into table 
         """
 
+        columns:list[list] = [list(column) for column in zip(*data)]
         try:
-            execute_values(self.cur, sql, data)
-            self.conn.commit()
+            self.execute_prepared(sql, columns)
         except Exception:
             self.conn.rollback()
+            raise
     
+    def copy_manager(self, table:str, columns:typing.Sequence[str]
+                    ) -> CopyManager:
+        """Creates manager for binary copy to database table
+
+        Manager reads column types from database once, 
+        so it should be created once and reused for every copy.
+
+        Parameters
+        ----------
+        table: str
+            Target table name
+        columns: Sequence[str]
+            Target column names (in the order of values in rows)
+
+        Returns
+        -------
+        CopyManager
+            pgcopy manager bound to the database connection
+        """
+
+        return CopyManager(self.conn, table, columns)
+
+    def write_binary(self, manager:CopyManager, 
+                    rows:typing.Iterable[tuple]) -> io.BytesIO:
+        """Serializes data to binary COPY format (nothing is sent to database)
+
+        Parameters
+        ----------
+        manager: CopyManager
+            Manager created by copy_manager method
+        rows: Iterable[tuple]
+            Tuples of values to copy into table (can be a generator)
+
+        Returns
+        -------
+        BytesIO
+            In-memory stream with serialized data, rewound to the start
+        """
+
+        stream = io.BytesIO()
+        manager.writestream(rows, stream)
+        stream.seek(0)
+        return stream
+
+    def copy_binary_stream(self, manager:CopyManager, 
+                        stream:typing.BinaryIO) -> None:
+        """Copies data serialized by write_binary method to database table
+
+        Can be called from other thread to overlap sending data 
+        with preparing next data (connection must not be used meanwhile).
+
+        Parameters
+        ----------
+        manager: CopyManager
+            Manager created by copy_manager method
+        stream: BinaryIO
+            Stream with data in binary COPY format
+        """
+
+        try:
+            manager.copystream(stream)
+        except Exception:
+            self.conn.rollback()
+            raise
+
     def insert_by_select_from(self, sql:str) -> None:
         """Inserts data from database table to database table
         
@@ -101,9 +294,48 @@ class Database:
 
         try:
             self.cur.execute(sql)
-            self.conn.commit()
         except Exception:
             self.conn.rollback()
+            raise
+
+    def execute_prepared(self, sql:str, 
+                        values:typing.Union[typing.Dict[str,typing.Any], 
+                                            typing.Sequence[typing.Any]]=None
+                        ) -> None:
+        """Executes SQL statement as prepared statement
+
+        Statement is parsed and planned by the server once per connection 
+        ('PREPARE'), next executions only send values ('EXECUTE').
+        Intended for repeated statements with fixed text and parameter types 
+        (every parameter cast, e.g. %s::int[]) - placeholders are passed 
+        to the server as they are, so '%%' escapes, tuples adapted to lists 
+        (IN %s) and untyped NULL parameters are not supported.
+
+        Parameters
+        ----------
+        sql: str
+            SQL statement with query placeholders (%(name)s or %s)
+        values: Dict[str, Any] or Sequence[Any], optional
+            Values inserted into query placeholders
+        """
+
+        names:list[str] = list(dict.fromkeys(re.findall(r'%\((\w+)\)s', sql)))
+        positional_count:int = sql.count('%s')
+        if sql not in self.prepared_statements:
+            statement_name:str = f'statement_{len(self.prepared_statements)}'
+            # Query placeholders are replaced by positional parameters ($1, ...)
+            positions:typing.Iterator[int] = count(1)
+            positional_sql:str = re.sub(r'%\((\w+)\)s|%s', 
+                            lambda m: f'${names.index(m[1]) + 1}' if m[1] 
+                                    else f'${next(positions)}', sql)
+            self.cur.execute(f'PREPARE {statement_name} AS {positional_sql}')
+            self.prepared_statements[sql] = statement_name
+        execute_sql:str = f'EXECUTE {self.prepared_statements[sql]}'
+        if names:
+            execute_sql += f" ({', '.join(f'%({name})s' for name in names)})"
+        elif positional_count:
+            execute_sql += f" ({', '.join(['%s'] * positional_count)})"
+        self.cur.execute(execute_sql, values)
 
     def select_all(self, sql:str, 
                 values:typing.Dict[str,typing.Any]=None
@@ -128,6 +360,45 @@ class Database:
         data:list[tuple] = self.cur.fetchall()
         return (column_names, data)
 
+    def select_stream(self, sql:str, 
+                    values:typing.Dict[str,typing.Any]=None
+                    ) -> tuple[list[str], typing.Iterator[tuple]]:
+        """Selects data from database by server-side cursor
+
+        Records are fetched in batches of 2000 records while iterating 
+        (for large results which should not be fetched into memory at once).
+
+        Parameters
+        ----------
+        sql: str
+            SQL 'SELECT * FROM ...' statement with query placeholders (%s)
+        values: Dict[str, Any], optional
+            Values inserted into query placeholders
+            
+        Returns
+        -------
+        tuple[list[str], Iterator[tuple]]
+            tuple[list[column names], generator of query records]
+        """
+
+        cur = self.conn.cursor(name=f'select_stream_{uuid.uuid4().hex}')
+        cur.itersize = 2000
+        cur.execute(sql, values)
+        records:typing.Iterator[tuple] = iter(cur)
+        # Columns are described after the first batch is fetched
+        first_records:list[tuple] = list(islice(records, 1))
+        column_names:list[str] = [desc[0] for desc in cur.description]
+        return (column_names, 
+                self.stream_records(cur, chain(first_records, records)))
+
+    @staticmethod
+    def stream_records(cur, records:typing.Iterable[tuple]
+                    ) -> typing.Iterator[tuple]:
+        """Yields records and closes server-side cursor when they are consumed"""
+
+        with cur:
+            yield from records
+
 
 def db_config(filename:str, section:str) -> typing.Dict[str,str]:
     """Loads database parameters from .ini file
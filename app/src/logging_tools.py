@@ -2,8 +2,9 @@
 
 This module contains a decorator for logging the flow of running functions in your script.
 
-This module contains the following decorator:
+This module contains the following functions:
 
+    * configure_logging - set up logging to file (call once, at script start)
     * func_status - wrap you function with logging to file
 """
 
@@ -13,11 +14,20 @@ from time import perf_counter
 
 LOG_FILE = './logfile.log'
 LOG_LEVEL = logging.INFO
-logging.basicConfig(level=LOG_LEVEL, filename=LOG_FILE, filemode='w',
-					format='%(asctime)-15s %(levelname)-8s %(message)s')
 logger = logging.getLogger('logger')
 
 
+def configure_logging() -> None:
+    """Sets up logging to file (LOG_FILE is overwritten)
+
+    Called by the script instead of on import, 
+    so importing this module does not open the log file
+    """
+
+    logging.basicConfig(level=LOG_LEVEL, filename=LOG_FILE, filemode='w',
+					format='%(asctime)-15s %(levelname)-8s %(message)s')
+
+
 def func_status(func):
     """Gets function and wraps it with logging to file
     Logs start of the function and end of the function with a running time 
@@ -34,11 +44,14 @@ def func_status(func):
     """
 
     def wrapper(*args, **kwargs):
-        logger.info(f'Entered function: {func.__name__}')
+        # Messages are not formatted when logging is not enabled
+        if not logger.isEnabledFor(logging.INFO):
+            return func(*args, **kwargs)
+        logger.info('Entered function: %s', func.__name__)
         time_start = perf_counter()
         wrapped_func = func(*args, **kwargs)
         time_end = perf_counter() - time_start
-        logger.info(f"""Exited function: {func.__name__} \
-with running time: {time_end:0.4} seconds""")
+        logger.info('Exited function: %s with running time: %0.4g seconds', 
+                    func.__name__, time_end)
         return wrapped_func
     return wrapper
\ No newline at end of file